@@ -1,31 +1,53 @@
 from flask import Flask, render_template, request, send_file, jsonify
 from werkzeug.utils import secure_filename
-import io
+import asyncio
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime
-from ppt_builder import build_presentation
-from llm_providers import plan_slides_via_llm, ProviderError
+from ppt_builder import build_presentation, template_hash
+from llm_providers import (
+    plan_slides_via_llm, cached_plan, remember_plan, validate_api_key, run_sync, ProviderError
+)
 
 # Flask app
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024  # 20 MB upload limit
 app.config['UPLOAD_EXTENSIONS'] = ['.pptx', '.potx']
 
-# --- Key format validator ---
-def _key_looks_like(provider: str, api_key: str) -> bool:
-    p = (provider or "").lower()
-    k = api_key or ""
-    if p == "openai":
-        return k.startswith("sk-")
-    if p == "anthropic":
-        return k.startswith("sk-ant-")
-    if p in ("google", "gemini", "google-gemini"):
-        return k.startswith("AIza") or len(k) > 25
-    if p == "perplexity":
-        return k.startswith("pplx-")
-    if p == "aipipe":
-        return k.startswith("eyJ") or k.startswith("ap_") or len(k) > 25
-    return True
+# /plan_batch: max plans per call, and how many items are planned at once. Each item
+# tries its models one after another, so this is also the cap on provider calls in
+# flight per batch; keep it below the HTTP pool size (llm_providers.HTTP_LIMITS).
+MAX_BATCH_PLANS = 20
+BATCH_CONCURRENCY = 8
+
+# PPTX assembly is CPU-bound; run it on a bounded pool sized to the machine. Builds that
+# overrun PPTX_BUILD_TIMEOUT_SECONDS get a 504 but keep running to completion.
+PPTX_BUILD_TIMEOUT_SECONDS = 120
+_PPTX_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="pptx-build")
+
+# Recently uploaded templates, keyed by SHA-256. /generate returns the hash in the
+# X-Template-Hash header; sending it back as `templateHash` skips the re-upload.
+TEMPLATE_CACHE_SIZE = 8
+_TEMPLATES = OrderedDict()
+_TEMPLATES_LOCK = threading.Lock()
+
+def _remember_template(template_bytes: bytes) -> str:
+    key = template_hash(template_bytes)
+    with _TEMPLATES_LOCK:
+        _TEMPLATES[key] = template_bytes
+        _TEMPLATES.move_to_end(key)
+        while len(_TEMPLATES) > TEMPLATE_CACHE_SIZE:
+            _TEMPLATES.popitem(last=False)
+    return key
+
+def _cached_template(key: str):
+    with _TEMPLATES_LOCK:
+        template_bytes = _TEMPLATES.get(key)
+        if template_bytes is not None:
+            _TEMPLATES.move_to_end(key)
+        return template_bytes
 
 # --- Same-provider fallback models ---
 def _fallback_models(provider: str, current: str | None):
@@ -58,37 +80,41 @@ def index():
     return render_template("index.html")
 
 
-def _plan_with_fallback(provider, model, api_key, input_text, guidance, include_notes):
-    """Try main model, then safe same-provider fallbacks."""
-    if not _key_looks_like(provider, api_key):
-        raise ProviderError(f"API key does not look like a {provider} key. Please check.")
+async def _plan_with_fallback(provider, model, api_key, input_text, guidance, include_notes):
+    """Try main model, then safe same-provider fallbacks, strictly one after another.
 
-    def attempt(m):
-        return plan_slides_via_llm(
-            provider=provider,
-            model=m or None,
-            api_key=api_key,
-            input_text=input_text,
-            guidance=guidance,
-            include_notes=include_notes
-        )
+    Fallbacks are deliberately not raced: one only starts once the previous attempt has
+    failed, so a slow but healthy model is never overtaken by (or billed alongside)
+    another one. The calling Flask thread waits in run_sync for the whole sequence; the
+    async client buys pooled keep-alive connections and concurrency across /plan_batch
+    items, not a shorter wait for a failing model. Only the requested
+    model's cached plan is checked up front; a winning fallback's plan is also cached
+    under the requested model so a repeat request skips the failing primary.
+    """
+    validate_api_key(provider, api_key)
 
-    try:
-        return attempt(model)
-    except ProviderError as e:
-        msg = str(e)
-        candidates = _fallback_models(provider, model)
-        # Special case: Perplexity invalid → force chat models
-        if ("invalid model" in msg.lower() or "not found" in msg.lower()) and provider.lower() == "perplexity":
-            candidates = ["sonar-small-chat", "sonar-medium-chat"]
+    hit = cached_plan(provider, model or None, input_text, guidance, include_notes)
+    if hit is not None:
+        return hit
 
-        last_err = msg
-        for alt in candidates:
-            try:
-                return attempt(alt)
-            except ProviderError as e2:
-                last_err = str(e2)
-        raise ProviderError(last_err)
+    last_err = "No model attempts were made."
+    for m in [model] + _fallback_models(provider, model):
+        try:
+            slides = await plan_slides_via_llm(
+                provider=provider,
+                model=m or None,
+                api_key=api_key,
+                input_text=input_text,
+                guidance=guidance,
+                include_notes=include_notes
+            )
+        except ProviderError as e:
+            last_err = str(e)
+            continue
+        if m != model:
+            remember_plan(provider, model or None, input_text, guidance, include_notes, slides)
+        return slides
+    raise ProviderError(last_err)
 
 
 @app.route("/generate", methods=["POST"])
@@ -106,37 +132,51 @@ def generate():
         if not api_key:
             return jsonify({"ok": False, "error": "API key is required for the selected provider."}), 400
 
-        # Validate uploaded file
+        # Validate uploaded file, or reuse a recently uploaded template by hash
         f = request.files.get("templateFile", None)
+        template_key = request.form.get("templateHash", "").strip()
+        template_bytes = None
         if f is None or f.filename == "":
-            return jsonify({"ok": False, "error": "Please upload a .pptx or .potx template/presentation."}), 400
-        filename = secure_filename(f.filename)
-        ext = os.path.splitext(filename)[1].lower()
-        if ext not in app.config['UPLOAD_EXTENSIONS']:
-            return jsonify({"ok": False, "error": "Only .pptx or .potx files are supported."}), 400
-        template_bytes = f.read()
+            if template_key:
+                template_bytes = _cached_template(template_key)
+            if template_bytes is None:
+                return jsonify({"ok": False, "error": "Please upload a .pptx or .potx template/presentation."}), 400
+        else:
+            filename = secure_filename(f.filename)
+            ext = os.path.splitext(filename)[1].lower()
+            if ext not in app.config['UPLOAD_EXTENSIONS']:
+                return jsonify({"ok": False, "error": "Only .pptx or .potx files are supported."}), 400
+            template_bytes = f.read()
+            template_key = _remember_template(template_bytes)
 
         # Step 1: Ask LLM
         try:
-            slide_plan = _plan_with_fallback(provider, model, api_key, input_text, guidance, include_notes)
+            slide_plan = run_sync(_plan_with_fallback(provider, model, api_key, input_text, guidance, include_notes))
         except ProviderError as e:
             return jsonify({"ok": False, "error": f"LLM provider error ({provider}): {e}"}), 400
 
         # Step 2: Build PPTX
         try:
-            out_pptx = build_presentation(template_bytes, slide_plan)
+            future = _PPTX_POOL.submit(build_presentation, template_bytes, slide_plan, template_key)
+            out_pptx = future.result(timeout=PPTX_BUILD_TIMEOUT_SECONDS)
+        except FutureTimeout:
+            # A running build can't be cancelled; it finishes in the background and keeps
+            # its pool worker until then, so slow templates still count against the pool.
+            return jsonify({"ok": False, "error": f"Building the PPTX took longer than {PPTX_BUILD_TIMEOUT_SECONDS}s."}), 504
         except Exception as e:
             return jsonify({"ok": False, "error": f"Failed to build PPTX: {e}"}), 500
 
         # Step 3: Return file
         stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
         out_name = f"text-to-pptx-{stamp}.pptx"
-        return send_file(
-            io.BytesIO(out_pptx),
+        resp = send_file(
+            out_pptx,
             mimetype="application/vnd.openxmlformats-officedocument.presentationml.presentation",
             as_attachment=True,
             download_name=out_name
         )
+        resp.headers['X-Template-Hash'] = template_key
+        return resp
 
     except Exception as e:
         return jsonify({"ok": False, "error": f"Unexpected error: {e}"}), 500
@@ -157,7 +197,7 @@ def preview():
         if not api_key:
             return jsonify({"ok": False, "error": "API key is required for the selected provider."}), 400
 
-        slide_plan = _plan_with_fallback(provider, model, api_key, input_text, guidance, include_notes)
+        slide_plan = run_sync(_plan_with_fallback(provider, model, api_key, input_text, guidance, include_notes))
         return jsonify({"ok": True, "slides": slide_plan})
 
     except ProviderError as e:
@@ -166,6 +206,68 @@ def preview():
         return jsonify({"ok": False, "error": f"Unexpected error: {e}"}), 500
 
 
+async def _plan_batch(items):
+    """Plan every batch item concurrently (bounded by BATCH_CONCURRENCY); results keep input order."""
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def one(item):
+        async with sem:
+            slides = await _plan_with_fallback(
+                item["provider"], item["model"], item["api_key"],
+                item["input_text"], item["guidance"], item["include_notes"]
+            )
+            return {"ok": True, "slides": slides}
+
+    # A failing item becomes an error entry instead of failing the whole batch.
+    results = await asyncio.gather(*[one(item) for item in items], return_exceptions=True)
+    for i, res in enumerate(results):
+        if isinstance(res, ProviderError):
+            results[i] = {"ok": False, "error": f"LLM provider error ({items[i]['provider']}): {res}"}
+        elif isinstance(res, BaseException):
+            results[i] = {"ok": False, "error": f"Unexpected error: {res}"}
+    return results
+
+
+@app.route("/plan_batch", methods=["POST"])
+def plan_batch():
+    """
+    JSON array of {input_text, guidance?, include_notes?, provider?, model?, api_key}.
+    Returns {"ok": true, "results": [...]} with one {ok, slides|error} per item, in order.
+    """
+    try:
+        batch = request.get_json(silent=True)
+        if not isinstance(batch, list) or not batch:
+            return jsonify({"ok": False, "error": "Expected a non-empty JSON array of plan requests."}), 400
+        if len(batch) > MAX_BATCH_PLANS:
+            return jsonify({"ok": False, "error": f"At most {MAX_BATCH_PLANS} plan requests per batch."}), 400
+
+        items = []
+        for i, req in enumerate(batch):
+            if not isinstance(req, dict):
+                return jsonify({"ok": False, "error": f"Item {i}: expected an object."}), 400
+            item = {
+                "input_text": str(req.get("input_text") or "").strip(),
+                "guidance": str(req.get("guidance") or "").strip(),
+                "include_notes": req.get("include_notes", False),
+                "provider": str(req.get("provider") or "openai").strip(),
+                "model": str(req.get("model") or "").strip(),
+                "api_key": str(req.get("api_key") or "").strip(),
+            }
+            if not isinstance(item["include_notes"], bool):
+                return jsonify({"ok": False, "error": f"Item {i}: include_notes must be true or false."}), 400
+            if not item["input_text"]:
+                return jsonify({"ok": False, "error": f"Item {i}: input_text is required."}), 400
+            if not item["api_key"]:
+                return jsonify({"ok": False, "error": f"Item {i}: api_key is required for the selected provider."}), 400
+            items.append(item)
+
+        results = run_sync(_plan_batch(items))
+        return jsonify({"ok": True, "results": results})
+
+    except Exception as e:
+        return jsonify({"ok": False, "error": f"Unexpected error: {e}"}), 500
+
+
 if __name__ == "__main__":
     port = int(8000)
     app.run(host="0.0.0.0", port=port, debug=False)
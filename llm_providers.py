@@ -1,5 +1,7 @@
-import os, json, re
-import requests
+import os, re, asyncio, copy, hashlib, threading, time
+from collections import OrderedDict
+import httpx
+import orjson
 
 class ProviderError(Exception):
     pass
@@ -43,7 +45,94 @@ SOURCE TEXT:
 
 # ---------- Provider POST helpers ----------
 
-def _post_openai(api_key, model, system, user):
+# All provider traffic goes through one long-lived event loop thread and one pooled
+# AsyncClient on it, so keep-alive connections (and their TLS sessions) survive
+# across Flask requests. An AsyncClient cannot be shared between asyncio.run() loops.
+HTTP_TIMEOUT = 60
+HTTP_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10)
+HTTP_CONNECT_RETRIES = 2
+HTTP_STATUS_RETRIES = 2
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+HTTP_BACKOFF_FACTOR = 0.2
+
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+_CLIENT = None
+
+def _http_loop():
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-http", daemon=True).start()
+            _LOOP = loop
+    return _LOOP
+
+def run_sync(coro):
+    """Run a coroutine on the shared HTTP loop from a sync (Flask) thread and return its result."""
+    return asyncio.run_coroutine_threadsafe(coro, _http_loop()).result()
+
+def _client():
+    # Only touched from the loop thread, so no lock is needed.
+    global _CLIENT
+    if _CLIENT is None:
+        transport = httpx.AsyncHTTPTransport(retries=HTTP_CONNECT_RETRIES, limits=HTTP_LIMITS)
+        _CLIENT = httpx.AsyncClient(timeout=HTTP_TIMEOUT, transport=transport)
+    return _CLIENT
+
+async def _stream(label, url, headers, payload, delta):
+    """
+    POST JSON (encoded with orjson) on the pooled client with a Server-Sent Events response,
+    concatenating the text that `delta(event)` pulls out of each `data:` event as it arrives.
+    Returns (status_code, text); on HTTP errors text is the start of the error body.
+    Transient statuses are retried with exponential backoff; transport failures surface as
+    ProviderError so fallbacks can take over.
+    """
+    for attempt in range(HTTP_STATUS_RETRIES + 1):
+        try:
+            async with _client().stream("POST", url, headers=headers, content=orjson.dumps(payload)) as r:
+                status = r.status_code
+                if status >= 400:
+                    if status in HTTP_RETRY_STATUSES and attempt < HTTP_STATUS_RETRIES:
+                        await asyncio.sleep(HTTP_BACKOFF_FACTOR * (2 ** attempt))
+                        continue
+                    body = await r.aread()
+                    return status, body[:200].decode("utf-8", "replace")
+
+                parts = []
+                async for line in r.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if not data or data == "[DONE]":
+                        continue
+                    try:
+                        event = orjson.loads(data)
+                    except orjson.JSONDecodeError:
+                        raise ProviderError(f"{label} sent a malformed stream event")
+                    if isinstance(event, dict) and event.get("error"):
+                        err = event["error"]
+                        raise ProviderError(f"{label} stream error: {err.get('message', err) if isinstance(err, dict) else err}")
+                    piece = delta(event)
+                    if piece:
+                        parts.append(piece)
+                return status, "".join(parts)
+        except httpx.HTTPError as e:
+            raise ProviderError(f"{label} request failed: {e.__class__.__name__}")
+
+def _openai_delta(event):
+    try:
+        return event["choices"][0]["delta"].get("content")
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+def _gemini_delta(event):
+    try:
+        return "".join(p.get("text", "") for p in event["candidates"][0]["content"]["parts"])
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+async def _post_openai(api_key, model, system, user):
     url = "https://api.openai.com/v1/chat/completions"
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -56,21 +145,20 @@ def _post_openai(api_key, model, system, user):
             {"role": "user", "content": user}
         ],
         "temperature": 0.2,
-        "response_format": {"type": "json_object"}
+        "response_format": {"type": "json_object"},
+        "stream": True,
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=60)
-    if r.status_code >= 400:
-        raise ProviderError(f"OpenAI API error {r.status_code}: {r.text[:200]}")
-    data = r.json()
-    try:
-        return data["choices"][0]["message"]["content"]
-    except Exception:
+    status, text = await _stream("OpenAI", url, headers, payload, _openai_delta)
+    if status >= 400:
+        raise ProviderError(f"OpenAI API error {status}: {text}")
+    if not text:
         raise ProviderError("OpenAI response missing content")
+    return text
 
-def _post_aipipe(api_key, model, system, user):
+async def _post_aipipe(api_key, model, system, user):
     """
-    AI-Pipe proxy is OpenAI-compatible but some routes 400 if response_format is used.
-    We'll try once WITH response_format, and if 400, retry WITHOUT it.
+    AI-Pipe proxy is OpenAI-compatible (including streaming) but some routes 400 if
+    response_format is used. We'll try once WITH response_format, and if 400, retry WITHOUT it.
     """
     url = "https://aipipe.org/openai/v1/chat/completions"
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
@@ -83,24 +171,23 @@ def _post_aipipe(api_key, model, system, user):
         ],
         "temperature": 0.2,
         "response_format": {"type": "json_object"},
+        "stream": True,
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=60)
-    if r.status_code == 400:
+    status, text = await _stream("AI-Pipe", url, headers, payload, _openai_delta)
+    if status == 400:
         # Retry without response_format
         payload.pop("response_format", None)
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
+        status, text = await _stream("AI-Pipe", url, headers, payload, _openai_delta)
 
-    if r.status_code >= 400:
-        raise ProviderError(f"AI-Pipe API error {r.status_code}: {r.text[:200]}")
-    data = r.json()
-    try:
-        return data["choices"][0]["message"]["content"]
-    except Exception:
+    if status >= 400:
+        raise ProviderError(f"AI-Pipe API error {status}: {text}")
+    if not text:
         raise ProviderError("AI-Pipe response missing content")
+    return text
 
-def _post_gemini(api_key, model, system, user):
+async def _post_gemini(api_key, model, system, user):
     model_name = model or PROVIDER_DEFAULTS["gemini"]
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:generateContent?key={api_key}"
+    url = f"https://generativelanguage.googleapis.com/v1beta/models/{model_name}:streamGenerateContent?alt=sse&key={api_key}"
     headers = {"content-type": "application/json"}
     # Concatenate system+user into a single user message; Gemini doesn't use system separately in v1beta.
     prompt = f"{system}\n\nUser Input:\n{user}\n\nReturn STRICT JSON only."
@@ -108,20 +195,59 @@ def _post_gemini(api_key, model, system, user):
         "contents": [{"role": "user", "parts": [{"text": prompt}]}],
         "generationConfig": {"temperature": 0.2}
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=60)
-    if r.status_code >= 400:
-        raise ProviderError(f"Gemini API error {r.status_code}: {r.text[:200]}")
-    data = r.json()
-    try:
-        return data["candidates"][0]["content"]["parts"][0]["text"]
-    except Exception:
+    status, text = await _stream("Gemini", url, headers, payload, _gemini_delta)
+    if status >= 400:
+        raise ProviderError(f"Gemini API error {status}: {text}")
+    if not text:
         raise ProviderError("Gemini response missing text content")
+    return text
 
 # ---------- JSON coercion / safety ----------
 
-_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.S)
 _THINK_RE = re.compile(r"<think>.*?</think>", re.S)
 
+def _strip_fence(s: str) -> str:
+    """Return the body of the first ```json ... ``` / ``` ... ``` block, or s unchanged."""
+    start = s.find("```")
+    if start == -1:
+        return s
+    end = s.find("```", start + 3)
+    if end == -1:
+        return s
+    body = s[start + 3:end]
+    if body.startswith("json"):
+        body = body[4:]
+    return body.strip()
+
+def _extract_json_object(s: str):
+    """
+    Single pass from the first '{' to its matching '}', tracking depth and skipping
+    braces inside string literals. Returns the object text, or None if unbalanced.
+    """
+    start = s.find("{")
+    if start == -1:
+        return None
+    depth = 0
+    in_string = escape = False
+    for i in range(start, len(s)):
+        c = s[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0:
+                return s[start:i + 1]
+    return None
+
 def _coerce_json(text: str):
     """
     Accepts raw model text, extracts fenced JSON if present, strips Perplexity <think> blocks,
@@ -132,49 +258,161 @@ def _coerce_json(text: str):
 
     s = text.strip()
     # Remove Perplexity <think>...</think> if present
-    s = _THINK_RE.sub("", s)
+    if "<think>" in s:
+        s = _THINK_RE.sub("", s)
 
     # Prefer fenced ```json ... ``` or ``` ... ``` blocks
-    m = _FENCE_RE.search(s)
-    if m:
-        s = m.group(1).strip()
+    s = _strip_fence(s)
 
     # If the string doesn't start with '{', try to locate the first JSON object
     if not s.startswith("{"):
-        m2 = re.search(r"\{.*\}", s, flags=re.S)
-        if m2:
-            s = m2.group(0).strip()
+        obj = _extract_json_object(s)
+        if obj is not None:
+            s = obj
 
     try:
-        return json.loads(s)
-    except json.JSONDecodeError as e:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError as e:
         raise ProviderError(f"Provider returned non-JSON output: {e}")
 
+# ---------- Input budgeting ----------
+
+# Source text is capped by approximate token count rather than characters, so CJK/code
+# inputs are not over-sent and plain prose is not cut short. tiktoken is optional.
+INPUT_TOKEN_BUDGET = 6000
+BYTES_PER_TOKEN_ESTIMATE = 4
+
+_ENCODERS = {}  # model -> tiktoken encoding, or None when unavailable
+
+def _encoder_for(model):
+    if model not in _ENCODERS:
+        try:
+            import tiktoken
+            _ENCODERS[model] = tiktoken.encoding_for_model(model)
+        except Exception:
+            _ENCODERS[model] = None
+    return _ENCODERS[model]
+
+def _truncate_to_tokens(text: str, model, max_tokens: int = INPUT_TOKEN_BUDGET, use_tokenizer: bool = True) -> str:
+    """Trim text to roughly max_tokens, using tiktoken when it knows the model, else a UTF-8 byte estimate."""
+    enc = _encoder_for(model) if (use_tokenizer and model) else None
+    if enc is not None:
+        tokens = enc.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else enc.decode(tokens[:max_tokens])
+    limit = max_tokens * BYTES_PER_TOKEN_ESTIMATE
+    raw = text.encode("utf-8")
+    return text if len(raw) <= limit else raw[:limit].decode("utf-8", "ignore")
+
+# ---------- Slide-plan cache ----------
+
+# Preview followed by Generate with the same inputs is the common flow; keep parsed
+# plans around so the second request skips the provider round-trip.
+PLAN_CACHE_MAXSIZE = 256
+PLAN_CACHE_TTL = 3600  # seconds
+
+_PLAN_CACHE = OrderedDict()  # key -> (stored_at, slides)
+_PLAN_CACHE_LOCK = threading.Lock()
+
+def _plan_cache_key(provider, model, input_text, guidance, include_notes):
+    raw = orjson.dumps([provider, model or "", input_text, guidance or "", bool(include_notes)], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(raw).hexdigest()
+
+def _plan_cache_get(key):
+    with _PLAN_CACHE_LOCK:
+        hit = _PLAN_CACHE.get(key)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] > PLAN_CACHE_TTL:
+            del _PLAN_CACHE[key]
+            return None
+        _PLAN_CACHE.move_to_end(key)
+        return copy.deepcopy(hit[1])
+
+def _plan_cache_put(key, slides):
+    with _PLAN_CACHE_LOCK:
+        _PLAN_CACHE[key] = (time.monotonic(), copy.deepcopy(slides))
+        _PLAN_CACHE.move_to_end(key)
+        while len(_PLAN_CACHE) > PLAN_CACHE_MAXSIZE:
+            _PLAN_CACHE.popitem(last=False)
+
+def cached_plan(provider, model, input_text, guidance, include_notes):
+    """Return a copy of the cached plan for these inputs, or None."""
+    return _plan_cache_get(_plan_cache_key((provider or "").lower(), model, input_text, guidance, include_notes))
+
+def remember_plan(provider, model, input_text, guidance, include_notes, slides):
+    """Cache slides under these inputs, e.g. a fallback's plan under the requested model."""
+    _plan_cache_put(_plan_cache_key((provider or "").lower(), model, input_text, guidance, include_notes), slides)
+
 # ---------- Public entrypoint ----------
 
-def _validate_api_key_like(s: str):
-    bad_substrings = [" ", "http", "Bearer ", "provider.lower()", "elif "]
-    if not s or any(x in s for x in bad_substrings) or len(s) < 20:
-        raise ProviderError("API key looks invalid. Paste only your provider token (no quotes/Bearer/spaces).")
+# One compiled pattern per provider covers both the generic token shape (20+ chars,
+# no whitespace, no pasted URL) and the provider's expected prefix.
+_KEY_SHAPE = r"(?!.*http)(?=\S{20,}\Z)"
+_KEY_PATTERNS = {
+    "openai":        re.compile(_KEY_SHAPE + r"sk-"),
+    "anthropic":     re.compile(_KEY_SHAPE + r"sk-ant-"),
+    "google":        re.compile(_KEY_SHAPE + r"(?:AIza|\S{26})"),
+    "gemini":        re.compile(_KEY_SHAPE + r"(?:AIza|\S{26})"),
+    "google-gemini": re.compile(_KEY_SHAPE + r"(?:AIza|\S{26})"),
+    "perplexity":    re.compile(_KEY_SHAPE + r"pplx-"),
+    "aipipe":        re.compile(_KEY_SHAPE + r"(?:eyJ|ap_|\S{26})"),
+}
+_GENERIC_KEY_PATTERN = re.compile(_KEY_SHAPE)
+
+# Digests of (provider, key) pairs that already passed, FIFO-capped. Only digests are kept.
+VALIDATED_KEYS_MAX = 1024
+_VALIDATED_KEYS = OrderedDict()
+_VALIDATED_KEYS_LOCK = threading.Lock()
 
-def plan_slides_via_llm(provider, model, api_key, input_text, guidance, include_notes):
-    _validate_api_key_like(api_key)
+def validate_api_key(provider, api_key):
+    """Raise ProviderError unless api_key looks like a token for this provider."""
     p = (provider or "").lower()
-    user = USER_TEMPLATE.format(guidance=guidance or "(none)", input_text=input_text[:15000])
+    k = api_key or ""
+    digest = hashlib.blake2b(f"{p}\0{k}".encode("utf-8"), digest_size=16).digest()
+    if digest in _VALIDATED_KEYS:
+        return
+    if not _KEY_PATTERNS.get(p, _GENERIC_KEY_PATTERN).match(k):
+        what = f"API key does not look like a {provider} key." if p in _KEY_PATTERNS else "API key looks invalid."
+        raise ProviderError(f"{what} Paste only your provider token (no quotes/Bearer/spaces).")
+    with _VALIDATED_KEYS_LOCK:
+        _VALIDATED_KEYS[digest] = None
+        while len(_VALIDATED_KEYS) > VALIDATED_KEYS_MAX:
+            _VALIDATED_KEYS.popitem(last=False)
+
+async def plan_slides_via_llm(provider, model, api_key, input_text, guidance, include_notes):
+    """Coroutine; must run on the shared HTTP loop (see run_sync)."""
+    p = (provider or "").lower()
+    validate_api_key(p, api_key)
+
+    cache_key = _plan_cache_key(p, model, input_text, guidance, include_notes)
+    cached = _plan_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    is_gemini = p in ("google", "gemini", "google-gemini")
+    budget_model = model or PROVIDER_DEFAULTS.get(p)
+    # Tokenizing (and tiktoken's first-use download) can be slow on big inputs; keep it off
+    # the shared HTTP loop so other users' streams aren't stalled.
+    input_text = await asyncio.to_thread(_truncate_to_tokens, input_text, budget_model, use_tokenizer=not is_gemini)
+    user = USER_TEMPLATE.format(guidance=guidance or "(none)", input_text=input_text)
 
     if p == "openai":
-        raw = _post_openai(api_key, model, SYSTEM_PROMPT, user)
-    elif p in ("google", "gemini", "google-gemini"):
-        raw = _post_gemini(api_key, model, SYSTEM_PROMPT, user)
+        raw = await _post_openai(api_key, model, SYSTEM_PROMPT, user)
+    elif is_gemini:
+        raw = await _post_gemini(api_key, model, SYSTEM_PROMPT, user)
     elif p == "aipipe":
-        raw = _post_aipipe(api_key, model, SYSTEM_PROMPT, user)
+        raw = await _post_aipipe(api_key, model, SYSTEM_PROMPT, user)
     else:
         raise ProviderError(f"Unsupported provider: {provider}")
 
     data = _coerce_json(raw)
+    if not isinstance(data, dict):
+        raise ProviderError("Provider returned JSON that is not an object.")
     slides = data.get("slides") or []
     if not isinstance(slides, list) or len(slides) == 0:
         raise ProviderError("No slides returned by provider.")
+    if not all(isinstance(s, dict) for s in slides):
+        raise ProviderError("Provider returned slides that are not objects.")
 
     # Normalize
     slides = slides[:30]
@@ -185,4 +423,6 @@ def plan_slides_via_llm(provider, model, api_key, input_text, guidance, include_
     for s in slides:
         if not s.get("layout_hint"):
             s["layout_hint"] = "title_and_content"
+
+    _plan_cache_put(cache_key, slides)
     return slides
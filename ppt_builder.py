@@ -1,9 +1,18 @@
 from pptx import Presentation
 from pptx.util import Inches, Pt
-from pptx.enum.shapes import MSO_SHAPE_TYPE
+from pptx.opc.constants import RELATIONSHIP_TYPE as RT
 from pptx.enum.shapes import PP_PLACEHOLDER
+from collections import OrderedDict
+import hashlib
 import io
 import random
+import threading
+
+# Per-template analysis (layout map + image blobs), keyed by SHA-256 of the template bytes.
+# The Presentation itself is re-opened per build because python-pptx mutates it.
+TEMPLATE_INFO_CACHE_SIZE = 8
+_TEMPLATE_INFO = OrderedDict()
+_TEMPLATE_INFO_LOCK = threading.Lock()
 
 # Map our layout hints to likely layout names in real templates.
 LAYOUT_PREFS = [
@@ -36,7 +45,7 @@ def _layout_has_body(layout):
         pass
     return False
 
-def _find_layout_index(prs: Presentation, layout_hint: str) -> int:
+def _find_layout_index(prs: Presentation, layout_hint: str, body_flags=None) -> int:
     """Pick a layout index; if the hint fails, prefer any layout that actually has BODY content."""
     prefs = next((p[1] for p in LAYOUT_PREFS if p[0] == layout_hint), None) or ["Title and Content", "Title Only"]
     # Try preferred names first
@@ -50,7 +59,7 @@ def _find_layout_index(prs: Presentation, layout_hint: str) -> int:
                 pass
     # Prefer any layout that clearly has BODY/text content
     for i, layout in enumerate(prs.slide_layouts):
-        if _layout_has_body(layout):
+        if (body_flags[i] if body_flags is not None else _layout_has_body(layout)):
             return i
     # Fallback: any layout containing "title"
     for i, layout in enumerate(prs.slide_layouts):
@@ -62,49 +71,126 @@ def _find_layout_index(prs: Presentation, layout_hint: str) -> int:
             pass
     return 0
 
+def _build_layout_map(prs: Presentation):
+    """
+    Resolve every layout hint once per template instead of once per slide.
+    Returns ({hint: layout_idx} with a None entry for unknown hints, [has_body per layout index]).
+    """
+    body_flags = [_layout_has_body(layout) for layout in prs.slide_layouts]
+    layout_map = {hint: _find_layout_index(prs, hint, body_flags) for hint, _ in LAYOUT_PREFS}
+    layout_map[None] = _find_layout_index(prs, None, body_flags)
+    return layout_map, body_flags
+
+# Blips of top-level picture shapes only (what MSO_SHAPE_TYPE.PICTURE covers): skips picture
+# placeholders, movies, background/shape fills, OLE/chart previews and SVG alternates.
+_PICTURE_BLIP_XPATH = (
+    "./p:cSld/p:spTree/p:pic"
+    "[not(p:nvPicPr/p:nvPr/p:ph) and not(p:nvPicPr/p:nvPr/a:videoFile)]"
+    "/p:blipFill/a:blip/@r:embed"
+)
+
 def _collect_template_images(prs: Presentation):
-    """Collect (blob, width, height) of images present in the uploaded template/presentation."""
+    """
+    Collect image blobs of the picture shapes on the uploaded template's slides, read from
+    the slide XML and package relationships (no shape objects). Shared images are listed
+    once; callers shuffle.
+    """
     images = []
-    for slide in prs.slides:
-        for shape in slide.shapes:
+    seen = set()
+    for rel in prs.part.rels.values():
+        if rel.is_external or rel.reltype != RT.SLIDE:
+            continue
+        slide_part = rel.target_part
+        for rId in slide_part._element.xpath(_PICTURE_BLIP_XPATH):
             try:
-                if shape.shape_type == MSO_SHAPE_TYPE.PICTURE and hasattr(shape, "image"):
-                    images.append((shape.image.blob, shape.width, shape.height))
+                part = slide_part.rels[rId].target_part
+                if id(part) in seen:
+                    continue
+                seen.add(id(part))
+                images.append(part.blob)
             except Exception:
                 continue
-    random.shuffle(images)
     return images
 
+def template_hash(template_bytes: bytes) -> str:
+    return hashlib.sha256(template_bytes).hexdigest()
+
+def _template_info(prs: Presentation, key: str):
+    """
+    Return (images, layout_map, body_flags) for this template, computing them on first use.
+    Purges the template's slides either way; images must be read before the purge.
+    """
+    with _TEMPLATE_INFO_LOCK:
+        info = _TEMPLATE_INFO.get(key)
+        if info is not None:
+            _TEMPLATE_INFO.move_to_end(key)
+    if info is not None:
+        _purge_all_existing_slides(prs)
+        return info
+
+    images = _collect_template_images(prs)
+    _purge_all_existing_slides(prs)
+    layout_map, body_flags = _build_layout_map(prs)
+    info = (images, layout_map, body_flags)
+    with _TEMPLATE_INFO_LOCK:
+        _TEMPLATE_INFO[key] = info
+        while len(_TEMPLATE_INFO) > TEMPLATE_INFO_CACHE_SIZE:
+            _TEMPLATE_INFO.popitem(last=False)
+    return info
+
 def _purge_all_existing_slides(prs: Presentation):
-    """Remove all existing slides while preserving masters/theme."""
+    """
+    Remove all existing slides while preserving masters/theme.
+    Done in bulk: drop every <p:sldId>, scan presentation.xml for r:id references once,
+    then pop the slide relationships nothing else points at (drop_rel rescans per call).
+    Unreferenced slide parts fall out of the package graph and are not saved.
+    """
     sldIdLst = prs.slides._sldIdLst
+    rIds = [sldId.rId for sldId in sldIdLst]
     for sldId in list(sldIdLst):
-        rId = sldId.rId
-        prs.part.drop_rel(rId)
         sldIdLst.remove(sldId)
+    still_referenced = set(prs.part._element.xpath("//@r:id"))
+    rels = prs.part.rels
+    for rId in rIds:
+        if rId not in still_referenced:
+            rels.pop(rId)
 
-def _first_placeholder(slide, allowed_types):
-    """Return the first placeholder whose placeholder_format.type is in allowed_types."""
+def _classify_placeholders(slide):
+    """
+    One pass over slide.placeholders, returning the first match of each kind:
+      title      - the idx-0 placeholder (what slide.shapes.title returns), else any TITLE_TYPES
+      body       - BODY/OBJECT content placeholder
+      text_other - any non-title placeholder with a text_frame (quirky templates)
+      picture    - PICTURE/SLIDE_IMAGE placeholder
+    """
+    found = {"title": None, "body": None, "text_other": None, "picture": None}
+    title_typed = None
     for shp in slide.placeholders:
         try:
-            if shp.placeholder_format and shp.placeholder_format.type in allowed_types:
-                return shp
+            if found["title"] is None and shp.placeholder_format.idx == 0:
+                found["title"] = shp
         except Exception:
             pass
-    return None
-
-def _first_text_capable_non_title(slide):
-    """Find any non-title placeholder that has a text_frame (for quirky templates)."""
-    for shp in slide.placeholders:
         try:
             t = shp.placeholder_format.type
+        except Exception:
+            continue
+        try:
             if t in TITLE_TYPES:
+                if title_typed is None:
+                    title_typed = shp
                 continue
-            if hasattr(shp, "text_frame") and shp.text_frame is not None:
-                return shp
+            if t in CONTENT_TYPES and found["body"] is None:
+                found["body"] = shp
+            if t in PICTURE_TYPES and found["picture"] is None:
+                found["picture"] = shp
+            if found["text_other"] is None and hasattr(shp, "text_frame") and shp.text_frame is not None:
+                found["text_other"] = shp
         except Exception:
             pass
-    return None
+    if found["title"] is None:
+        found["title"] = title_typed
+    return found
 
 def _set_text(shape, text: str):
     """Set text into a placeholder/textbox while letting the template's default run styles apply."""
@@ -154,58 +240,85 @@ def _ensure_notes(slide, text: str):
     except Exception:
         pass
 
-def _fill_picture_placeholder_if_any(slide, image_blob: bytes):
-    """If the layout provides a picture placeholder, insert image there to keep styling."""
+def _fill_picture_placeholder_if_any(slide, pic_ph, image_stream: io.BytesIO):
+    """If the layout provides a picture placeholder (pic_ph), insert image there to keep styling.
+    image_stream is reused across slides, so it is rewound before every read."""
     try:
-        pic_ph = _first_placeholder(slide, PICTURE_TYPES)
         if pic_ph is not None:
             try:
                 # Some picture placeholders support .insert_picture()
-                pic_ph.insert_picture(io.BytesIO(image_blob))
+                image_stream.seek(0)
+                pic_ph.insert_picture(image_stream)
                 return True
             except Exception:
                 # fallback: draw over the placeholder rect
                 left, top, width, height = pic_ph.left, pic_ph.top, pic_ph.width, pic_ph.height
-                slide.shapes.add_picture(io.BytesIO(image_blob), left, top, width=width, height=height)
+                image_stream.seek(0)
+                slide.shapes.add_picture(image_stream, left, top, width=width, height=height)
                 return True
     except Exception:
         pass
     return False
 
-def build_presentation(template_bytes: bytes, slides_plan):
+def _prepare_slide(idx: int, slide_data: dict, layout_map: dict, image_count: int) -> dict:
+    """
+    Resolve everything about one slide that doesn't need the Presentation: layout index,
+    clipped title/bullets, notes, and which template image (if any) to reuse.
+    """
+    hint = slide_data.get("layout_hint", "title_and_content")
+    if not isinstance(hint, str):
+        hint = None  # e.g. a list from a sloppy model; use the default layout
+    bullets = (slide_data.get("bullets") or [])[:12]
+    wants_image = image_count and ((idx % 3 == 0) or len(bullets) <= 2)
+    return {
+        "layout_idx": layout_map.get(hint, layout_map[None]),
+        "title": (slide_data.get("title") or "")[:200],
+        "bullets": bullets,
+        "notes": slide_data.get("notes", ""),
+        "image_idx": (idx % image_count) if wants_image else None,
+    }
+
+def build_presentation(template_bytes: bytes, slides_plan, template_key: str = None) -> io.BytesIO:
     """
     Build a new PPTX from the uploaded template and an LLM-produced slide plan.
     slides_plan is a list of dicts: {title, bullets, layout_hint, notes?}
+    template_key is template_hash(template_bytes) if the caller already has it.
+    Returns the saved deck as a BytesIO rewound to the start, ready for send_file.
     """
     prs = Presentation(io.BytesIO(template_bytes))
 
     # 1) Collect images then purge slides so template content doesn't leak in.
-    template_images = _collect_template_images(prs)
-    _purge_all_existing_slides(prs)
+    template_images, layout_map, body_flags = _template_info(prs, template_key or template_hash(template_bytes))
+    template_images = list(template_images)
+    random.shuffle(template_images)
+    # One stream per image, rewound on each use, instead of a fresh BytesIO per slide.
+    image_streams = [io.BytesIO(blob) for blob in template_images]
+
+    # 2) Resolve per-slide content up front; the loop below only mutates the deck.
+    specs = [_prepare_slide(idx, slide_data, layout_map, len(image_streams))
+             for idx, slide_data in enumerate(slides_plan)]
 
-    # 2) Build slides from plan
-    for idx, slide_data in enumerate(slides_plan):
-        hint = slide_data.get("layout_hint", "title_and_content")
-        layout_idx = _find_layout_index(prs, hint)
-        slide = prs.slides.add_slide(prs.slide_layouts[layout_idx])
+    # 3) Build slides from plan
+    for spec in specs:
+        slide = prs.slides.add_slide(prs.slide_layouts[spec["layout_idx"]])
+        phs = _classify_placeholders(slide)
 
         # If the chosen layout still lacks a body placeholder, try to switch to one that has it.
-        if _first_placeholder(slide, CONTENT_TYPES) is None and _first_text_capable_non_title(slide) is None:
+        if phs["body"] is None and phs["text_other"] is None:
             for i, layout in enumerate(prs.slide_layouts):
-                if _layout_has_body(layout):
+                if body_flags[i]:
                     slide = prs.slides.add_slide(layout)  # add a new one with content
+                    phs = _classify_placeholders(slide)
                     break
 
-        title_text = (slide_data.get("title") or "")[:200]
-        bullets = (slide_data.get("bullets") or [])[:12]
+        title_text = spec["title"]
+        bullets = spec["bullets"]
 
-        # Title: prefer slide.shapes.title first (respects theme), then title placeholders.
-        title_ph = getattr(slide.shapes, "title", None)
-        if title_ph is None:
-            title_ph = _first_placeholder(slide, TITLE_TYPES)
+        # Title: the idx-0 placeholder first (same as slide.shapes.title), then title-type placeholders.
+        title_ph = phs["title"]
 
         # Body/content: BODY, OBJECT (text), or any non-title text-capable placeholder.
-        body_ph = _first_placeholder(slide, CONTENT_TYPES) or _first_text_capable_non_title(slide)
+        body_ph = phs["body"] or phs["text_other"]
 
         if title_ph:
             _set_text(title_ph, title_text)
@@ -227,19 +340,21 @@ def build_presentation(template_bytes: bytes, slides_plan):
             except Exception:
                 pass
 
-        _ensure_notes(slide, slide_data.get("notes", ""))
+        _ensure_notes(slide, spec["notes"])
 
         # Reuse a template image in a way that keeps layout look-and-feel
-        if template_images and ((idx % 3 == 0) or len(bullets) <= 2):
-            blob, w, h = template_images[idx % len(template_images)]
-            placed = _fill_picture_placeholder_if_any(slide, blob)
+        if spec["image_idx"] is not None:
+            stream = image_streams[spec["image_idx"]]
+            placed = _fill_picture_placeholder_if_any(slide, phs["picture"], stream)
             if not placed:
                 # tasteful accent if no picture placeholder exists on layout
                 try:
-                    slide.shapes.add_picture(io.BytesIO(blob), Inches(0.4), Inches(5.1), height=Inches(1.2))
+                    stream.seek(0)
+                    slide.shapes.add_picture(stream, Inches(0.4), Inches(5.1), height=Inches(1.2))
                 except Exception:
                     pass
 
     out = io.BytesIO()
     prs.save(out)
-    return out.getvalue()
+    out.seek(0)
+    return out
@@ -0,0 +1,54 @@
+import json
+
+import httpx
+import pytest
+
+import app
+import llm_providers
+
+API_KEY = "sk-" + "x" * 30
+
+
+def _sse(content):
+    event = {"choices": [{"delta": {"content": content}}]}
+    return httpx.Response(200, text=f"data: {json.dumps(event)}\n\ndata: [DONE]\n\n")
+
+
+def _handler(request):
+    user = json.loads(request.content)["messages"][1]["content"]
+    if "array please" in user:
+        return _sse(json.dumps(["not", "an", "object"]))
+    return _sse(json.dumps({"slides": [{"title": "Good", "bullets": ["a"]}]}))
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(llm_providers, "_CLIENT", httpx.AsyncClient(transport=httpx.MockTransport(_handler)))
+    with llm_providers._PLAN_CACHE_LOCK:
+        llm_providers._PLAN_CACHE.clear()
+    return app.app.test_client()
+
+
+def test_failing_items_do_not_fail_the_batch(client):
+    batch = [
+        {"input_text": "good deck", "api_key": API_KEY},
+        {"input_text": "array please", "api_key": API_KEY},
+        {"input_text": "lone surrogate \ud800", "api_key": API_KEY},
+        {"input_text": "good deck again", "api_key": API_KEY},
+    ]
+    r = client.post("/plan_batch", data=json.dumps(batch), content_type="application/json")
+
+    assert r.status_code == 200
+    results = r.get_json()["results"]
+    assert [res["ok"] for res in results] == [True, False, False, True]
+    assert results[0]["slides"][0]["title"] == "Good"
+    assert "not an object" in results[1]["error"]
+    assert results[2]["error"]
+
+
+def test_include_notes_must_be_boolean(client):
+    batch = [{"input_text": "x", "api_key": API_KEY, "include_notes": "false"}]
+    r = client.post("/plan_batch", json=batch)
+
+    assert r.status_code == 400
+    assert "include_notes" in r.get_json()["error"]